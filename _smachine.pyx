@@ -0,0 +1,51 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""Compiled helpers for the smachine module.
+
+Build the extension in place with ``cythonize -i _smachine.pyx``, smachine
+uses the functions defined here in place of its pure Python versions when
+the extension can be imported.
+
+"""
+
+# Makes array.array support the buffer protocol on Python 2
+cimport cpython.array
+
+cdef enum:
+    TABLE_END = -1
+
+
+cdef int c_run_dfa(const int *table, int n_evt, int state,
+                   const int *events, Py_ssize_t n, int *trace,
+                   Py_ssize_t *n_trace) noexcept nogil:
+    cdef Py_ssize_t i
+    cdef int e, nxt
+    for i in range(n):
+        e = events[i]
+        if e >= 0:
+            nxt = table[state * n_evt + e]
+            if nxt == TABLE_END:
+                n_trace[0] = i
+                return TABLE_END
+            state = nxt
+        trace[i] = state
+    n_trace[0] = n
+    return state
+
+
+def run_dfa(const int[::1] table, int n_evt, int state,
+            const int[::1] events, int[::1] trace):
+    """Run a compiled transition table over a sequence of event indices.
+
+    Same as smachine.run_dfa(), the loop runs without holding the GIL.
+
+    """
+    cdef Py_ssize_t n = events.shape[0]
+    cdef Py_ssize_t n_trace = 0
+    if trace.shape[0] < n:
+        raise ValueError('trace is shorter than events')
+    if n == 0:
+        return state, 0
+    with nogil:
+        state = c_run_dfa(&table[0], n_evt, state, &events[0], n,
+                          &trace[0], &n_trace)
+    return state, n_trace
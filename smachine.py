@@ -9,8 +9,12 @@ The complete source is available `here
 
 """
 
-import unittest
-import doctest
+import array
+import collections
+import itertools
+import sys
+import types
+import weakref
 
 
 __author__ = 'Delio Brignoli'
@@ -23,39 +27,431 @@ __email__ = 'brignoli.delio@gmail.com'
 __status__ = 'Development'
 
 
-def state_machine(state_factory, transition_func):
-    """Return a state machine generator function."""
+# Functions compiled by _njit(), numba is only imported when one is needed
+_jitted = {}
+
+
+def _njit(func, **kwargs):
+    """Return `func` compiled with Numba, or as is when it is not installed.
+
+    Functions that are not Python functions, as when this module is itself
+    compiled with Cython, are left alone. Each function is only compiled
+    once.
+
+    """
+    jitted = _jitted.get(func)
+    if jitted is None:
+        jitted = func
+        if isinstance(func, types.FunctionType):
+            try:
+                from numba import njit
+            except ImportError:
+                pass
+            else:
+                jitted = njit(**kwargs)(func)
+        _jitted[func] = jitted
+    return jitted
+
+
+try:
+    _intern = intern
+except NameError:
+    _intern = sys.intern
+
+
+def _next_method(it):
+    """Return the bound method advancing the iterator `it`."""
+    try:
+        return it.__next__
+    except AttributeError:
+        return it.next
+
+
+TABLE_END = -1
+
+# Yielded by a state to exit, as returning does, without raising
+# StopIteration in the state machine.
+EXIT = object()
+
+# Returned by a transition function to stay in the current state.
+SAME = object()
+
+
+_MISS = object()
+
+_SubMachine = collections.namedtuple(
+    '_SubMachine', ('state_factory', 'transition_func'))
+
+# The state factory and transition function of the state machine generators
+# created by state_machine() and flat_state_machine(), used by the latter to
+# flatten them. Machines with reusable states are not registered.
+_machines = weakref.WeakKeyDictionary()
+
+
+def state_machine(state_factory, transition_func, reusable_states=(),
+                  pure_transition=False, transition_table=None,
+                  max_suspended=None):
+    """Return a state machine generator function.
+
+    The value yielded by the active state is passed on to the caller as is
+    rather than being repacked, so the state ID vector yielded by the state
+    machine is the very object yielded by the innermost state. Vectors are
+    tuples built once per transition, no vector is allocated for events
+    that do not cause a transition.
+
+    States whose ID is in `reusable_states` are not closed when they are
+    exited but kept suspended and resumed when they are entered again: the
+    event causing the transition is sent to the state like any other event
+    and its entry and exit code does not run again. Passing True as
+    `reusable_states` makes every state reusable, as does decorating the
+    state factory with reusable(). When `max_suspended` is given at most
+    that many states are kept suspended, the state that was suspended
+    first is closed to make room for a new one.
+
+    If the state factory has a `can_reuse` attribute it is called with the
+    current and next state IDs on each transition and, when it returns a
+    true value, the active state is kept and sent the transition event in
+    place of instantiating the next state.
+
+    When `pure_transition` is true the transition function is assumed to
+    depend only on the (state_id, event) tuple and not on the context: its
+    results are cached and it is called once per distinct tuple. The cache
+    is shared by all the instances of the returned state machine. State
+    IDs and events must be hashable.
+
+    A state exits, and the transition function is called with a None
+    event, when its generator returns or when it yields EXIT. Yielding EXIT
+    saves raising and catching StopIteration.
+
+    The transition function can return SAME rather than the current state
+    ID to stay in the current state, which saves comparing the two IDs.
+
+    The optional `transition_table` dictionary maps (state_id, event) tuples
+    to the next state ID. It takes precedence over the transition function,
+    which is then only called for the tuples missing from the table. The
+    table is copied once and never updated, the results of the transition
+    function are only cached when `pure_transition` is true.
+
+    """
+    can_reuse = getattr(state_factory, 'can_reuse', None)
+    if not reusable_states:
+        reusable_states = getattr(state_factory, 'reusable_states', ())
+    reuse_all = reusable_states is True
+    table = dict(transition_table) if transition_table is not None else None
+    shared_cache = {} if pure_transition else None
     def sm(ctx, s_id_vec=tuple(), evt=None):
-        state = None
+        # Bind the free variables and the active state's send method to
+        # local names, they are looked up on every event.
+        tf = transition_func
+        sf = state_factory
+        state = send = None
         state_id = s_id_vec[-1] if s_id_vec else None
+        base_vec = s_id_vec
+        suspended = collections.OrderedDict()
+        cache = shared_cache
         try:
             while True:
-                next_state_id = transition_func(ctx, (state_id, evt))
+                if table is None and cache is None:
+                    next_state_id = tf(ctx, (state_id, evt))
+                else:
+                    key = (state_id, evt)
+                    next_state_id = (_MISS if table is None else
+                                     table.get(key, _MISS))
+                    if next_state_id is _MISS:
+                        if cache is None:
+                            next_state_id = tf(ctx, key)
+                        else:
+                            next_state_id = cache.get(key, _MISS)
+                            if next_state_id is _MISS:
+                                next_state_id = cache[key] = tf(ctx, key)
                 if next_state_id is None:
                     break
                 try:
-                    if (next_state_id != state_id or state is None):
-                        if state is not None:
-                            state.close()
-                            s_id_vec = s_id_vec[:-1]
+                    if next_state_id is SAME and state is not None:
+                        val = send((ctx, s_id_vec, evt))
+                    elif (state is None or (next_state_id is not state_id and
+                                            next_state_id != state_id)):
+                        if next_state_id is SAME:
+                            next_state_id = state_id
+                            if next_state_id is None:
+                                break
+                        if state is not None and not (
+                                can_reuse is not None and
+                                can_reuse(state_id, next_state_id)):
+                            if reuse_all or state_id in reusable_states:
+                                suspended[state_id] = state
+                            else:
+                                state.close()
                             state = None
                         state_id = next_state_id
-                        s_id_vec = s_id_vec + (state_id,)
-                        state = state_factory(ctx, s_id_vec, evt)
-                        ctx, s_id_vec, evt = state.next()
+                        s_id_vec = base_vec + (state_id,)
+                        if state is None:
+                            state = suspended.pop(state_id, None)
+                            if (max_suspended is not None and
+                                    len(suspended) > max_suspended):
+                                suspended.popitem(False)[1].close()
+                        if state is not None:
+                            send = state.send
+                            val = send((ctx, s_id_vec, evt))
+                        else:
+                            state = sf(ctx, s_id_vec, evt)
+                            if isinstance(state, _SubMachine):
+                                state = state_machine(*state)(
+                                    ctx, s_id_vec, evt)
+                            send = state.send
+                            val = send(None)
                     else:
-                        ctx, s_id_vec, evt = state.send((ctx, s_id_vec, evt))
+                        val = send((ctx, s_id_vec, evt))
                 except StopIteration:
+                    state = send = None
+                    evt = None
+                    continue
+                if val is EXIT:
+                    state.close()
+                    state = send = None
                     evt = None
-                    s_id_vec = s_id_vec[:-1]
                     continue
-                ctx, _, evt = yield ctx, s_id_vec, evt
+                s_id_vec = val[1]
+                ctx, _, evt = yield val
                 if state_id is None:
                     break
         finally:
             if state is not None:
                 state.close()
-    return sm
+            for state in suspended.values():
+                state.close()
+    if reusable_states or can_reuse is not None or max_suspended is not None:
+        # Not registered, flat_state_machine() cannot suspend or keep the
+        # states and runs the machine as an ordinary state instead
+        return sm
+    # The function flat_state_machine() calls in place of the table lookup
+    if table is not None:
+        spec_tf = _table_transition(table, transition_func)
+    else:
+        spec_tf = transition_func
+    return _register_machine(sm, state_factory, spec_tf)
+
+
+def state_machine_from_table(tt, state_factory, transition_func=None,
+                             reusable_states=(), pure_transition=False):
+    """Return a state machine generator function for a transition table.
+
+    The next state is looked up in the `tt` dictionary mapping
+    (state_id, event) tuples to state IDs, without calling a transition
+    function for each event. Tuples missing from the table leave the state
+    unchanged unless an optional `transition_func` is given to resolve
+    them, see state_machine() for `pure_transition`.
+
+    """
+    if transition_func is None:
+        transition_func = _unchanged
+    return state_machine(state_factory, transition_func, reusable_states,
+                         pure_transition, transition_table=tt)
+
+
+def _unchanged(ctx, t):
+    return SAME
+
+
+def _table_transition(tt, transition_func):
+    """Return a transition function looking up `tt` first."""
+    get = tt.get
+    def transition(ctx, t):
+        next_state_id = get(t, _MISS)
+        if next_state_id is _MISS:
+            next_state_id = transition_func(ctx, t)
+        return next_state_id
+    return transition
+
+
+def reusable(state_factory):
+    """Decorate a state factory to make all of its states reusable.
+
+    state_machine() then suspends the states the factory returns when they
+    are exited and resumes them when they are entered again, as if True
+    was passed as its `reusable_states` argument.
+
+    """
+    state_factory.reusable_states = True
+    return state_factory
+
+
+def submachine(state_factory, transition_func):
+    """Return a nested state machine marker.
+
+    A state factory can return this marker in place of a state to nest a
+    state machine built from `state_factory` and `transition_func`.
+    state_machine() runs it as a nested state machine generator while
+    flat_state_machine() runs it without adding a generator per level.
+
+    """
+    return _SubMachine(state_factory, transition_func)
+
+
+def flat_state_machine(state_factory, transition_func, pure_transition=False):
+    """Return a state machine generator function flattening nested machines.
+
+    The generator behaves like the one returned by state_machine() but runs
+    nested state machines returned by the state factory itself, whether
+    they are submachine() markers or generators created by state_machine()
+    or flat_state_machine(). The active state machines are kept on a stack
+    and each event is sent straight to the innermost state, so that the
+    number of generators resumed per event does not grow with the nesting
+    depth.
+
+    When `pure_transition` is true the transition functions of the state
+    machine and of the nested ones are all assumed to be pure, as for
+    state_machine(), and their results are cached by transition function.
+
+    State machines with reusable states, or whose state factory has a
+    `can_reuse` attribute, are not flattened: nested ones are run as
+    ordinary states and for a top level state factory the state machine
+    returned is the one created by state_machine().
+
+    """
+    if _reuses_states(state_factory):
+        return state_machine(state_factory, transition_func,
+                             pure_transition=pure_transition)
+    # Transition functions that cannot be weakly referenced are kept in the
+    # plain dictionary for as long as the flat machine exists
+    if pure_transition:
+        caches = (weakref.WeakKeyDictionary(), {})
+    else:
+        caches = None
+    def sm(ctx, s_id_vec=tuple(), evt=None):
+        # A frame for each active state machine holding its state factory,
+        # transition function, state ID vector, active state ID, for the
+        # innermost frame the active state, and the transition cache.
+        frames = [[state_factory, transition_func, s_id_vec,
+                   s_id_vec[-1] if s_id_vec else None, None,
+                   _transition_cache(caches, transition_func)]]
+        level = 0
+        # The send method of the innermost state, set with frames[-1][4]
+        send = None
+        try:
+            while True:
+                frame = frames[level]
+                sf, tf, vec, state_id, state, cache = frame
+                if cache is None:
+                    next_state_id = tf(ctx, (state_id, evt))
+                else:
+                    key = (state_id, evt)
+                    next_state_id = cache.get(key, _MISS)
+                    if next_state_id is _MISS:
+                        next_state_id = cache[key] = tf(ctx, key)
+                if next_state_id is SAME:
+                    next_state_id = state_id
+                if next_state_id is None:
+                    _truncate_frames(frames, level)
+                    if level == 0:
+                        break
+                    level -= 1
+                    evt = None
+                    continue
+                nested = level + 1 < len(frames)
+                if ((next_state_id is not state_id and
+                        next_state_id != state_id) or
+                        (state is None and not nested)):
+                    _truncate_frames(frames, level + 1)
+                    frame[3] = state_id = next_state_id
+                    vec = vec + (state_id,)
+                    state = sf(ctx, vec, evt)
+                    if (isinstance(state, _SubMachine) and
+                            _reuses_states(state.state_factory)):
+                        state = state_machine(*state)(ctx, vec, evt)
+                    spec = _machine_spec(state)
+                    if spec is not None:
+                        frames.append([spec.state_factory,
+                                       spec.transition_func,
+                                       vec, state_id, None,
+                                       _transition_cache(
+                                           caches, spec.transition_func)])
+                        level += 1
+                        continue
+                    frame[4] = state
+                    send = state.send
+                    try:
+                        val = send(None)
+                    except StopIteration:
+                        frame[4] = None
+                        evt = None
+                        continue
+                elif nested:
+                    level += 1
+                    continue
+                else:
+                    try:
+                        val = send((ctx, s_id_vec, evt))
+                    except StopIteration:
+                        frame[4] = None
+                        evt = None
+                        continue
+                if val is EXIT:
+                    state.close()
+                    frame[4] = None
+                    evt = None
+                    continue
+                s_id_vec = val[1]
+                ctx, _, evt = yield val
+                level = 0
+        finally:
+            _truncate_frames(frames, 0)
+    return _register_machine(sm, state_factory, transition_func)
+
+
+def _reuses_states(state_factory):
+    """Return whether state_machine() can suspend or keep the states."""
+    return bool(getattr(state_factory, 'reusable_states', ()) or
+                getattr(state_factory, 'can_reuse', None) is not None)
+
+
+def _transition_cache(caches, transition_func):
+    """Return the cache of a pure transition function or None."""
+    if caches is None:
+        return None
+    weak, strong = caches
+    try:
+        owner = weak
+        cache = weak.get(transition_func)
+    except TypeError:
+        # Not weakly referenceable, see flat_state_machine()
+        owner = strong
+        cache = strong.get(transition_func)
+    if cache is None:
+        cache = owner[transition_func] = {}
+    return cache
+
+
+def _register_machine(sm, state_factory, transition_func):
+    """Wrap a state machine generator function to register its generators."""
+    spec = _SubMachine(state_factory, transition_func)
+    def new_sm(ctx, s_id_vec=tuple(), evt=None):
+        gen = sm(ctx, s_id_vec, evt)
+        _machines[gen] = spec
+        return gen
+    return new_sm
+
+
+def _machine_spec(state):
+    """Return the marker of a nested state machine or None for a state."""
+    if isinstance(state, _SubMachine):
+        return state
+    try:
+        spec = _machines.get(state)
+    except TypeError:
+        return None
+    if spec is not None:
+        # Not started, the machine is run by the frames instead
+        state.close()
+    return spec
+
+
+def _truncate_frames(frames, depth):
+    """Close the active state and drop the frames below `depth`."""
+    if frames and frames[-1][4] is not None:
+        frames[-1][4].close()
+        frames[-1][4] = None
+    del frames[depth:]
 
 
 def state_machine_from_class(cls):
@@ -63,10 +459,104 @@ def state_machine_from_class(cls):
 
     Creates a state machine from a class that encapsulates the state
     factory and state transition functions declared respectively as
-    `state_factory` and `transition` static methods.
+    `state_factory` and `transition` static methods. The IDs of reusable
+    states can be listed in an optional `REUSABLE_STATES` attribute and a
+    true `PURE_TRANSITION` attribute declares the transition function pure,
+    see state_machine().
+
+    A class can declare a `transition_table` dictionary, see
+    state_machine_from_table(), in place of or in addition to the
+    `transition` method. The state machine looks transitions up in a copy
+    of the table made by intern_table().
+
+    A class without a `state_factory` lists the IDs of its states in a
+    `STATES` attribute instead, each state being implemented by the static
+    method named after its ID, see state_factory_from_class().
 
     """
-    return state_machine(cls.state_factory, cls.transition)
+    reusable_states = getattr(cls, 'REUSABLE_STATES', ())
+    pure_transition = getattr(cls, 'PURE_TRANSITION', False)
+    state_factory = _class_state_factory(cls)
+    tt = getattr(cls, 'transition_table', None)
+    if tt is not None:
+        return state_machine_from_table(intern_table(tt), state_factory,
+                                        getattr(cls, 'transition', None),
+                                        reusable_states, pure_transition)
+    return state_machine(state_factory, cls.transition, reusable_states,
+                         pure_transition)
+
+
+def state_factory_from_class(cls, state_ids):
+    """Return a state factory instantiating the states of a class.
+
+    The state with ID ``s`` is implemented by the ``cls.s`` static method.
+    The methods are looked up once, for each ID in `state_ids`, rather than
+    with getattr() each time a state is entered.
+
+    """
+    ctors = dict((s, getattr(cls, s)) for s in state_ids)
+    def state_factory(ctx, s_id_vec, evt):
+        return ctors[s_id_vec[-1]](ctx, s_id_vec, evt)
+    return state_factory
+
+
+def _class_state_factory(cls):
+    state_factory = getattr(cls, 'state_factory', None)
+    if state_factory is None:
+        state_factory = state_factory_from_class(cls, cls.STATES)
+    return state_factory
+
+
+def compile_state_machine(cls):
+    """Create a state machine from a class with a static transition table.
+
+    Like state_machine_from_class() but the transition function is
+    generated from the `transition_table` dictionary of the class, mapping
+    (state_id, event) tuples to the next state ID. Each transition is
+    inlined in the generated function as a comparison with a constant and
+    pairs missing from the table leave the state unchanged. The
+    `REUSABLE_STATES` and `PURE_TRANSITION` attributes are honoured as by
+    state_machine_from_class().
+
+    """
+    return state_machine(_class_state_factory(cls),
+                         _compile_transition(cls.transition_table),
+                         getattr(cls, 'REUSABLE_STATES', ()),
+                         getattr(cls, 'PURE_TRANSITION', False))
+
+
+def _compile_transition(tt):
+    """Generate the source of a transition function for `tt` and exec it."""
+    namespace = {}
+    def literal(v):
+        return _literal(namespace, v)
+    def test(name, v):
+        if v is None:
+            return '%s is None' % name
+        return '%s == %s' % (name, literal(v))
+    edges = {}
+    for (state_id, evt), next_state_id in tt.items():
+        edges.setdefault(state_id, []).append((evt, next_state_id))
+    lines = ['def transition(ctx, t):', '    state_id, evt = t']
+    keyword = 'if'
+    for state_id, state_edges in edges.items():
+        lines.append('    %s %s:' % (keyword, test('state_id', state_id)))
+        for evt, next_state_id in state_edges:
+            lines.append('        if %s:' % test('evt', evt))
+            lines.append('            return %s' % literal(next_state_id))
+        keyword = 'elif'
+    lines.append('    return state_id')
+    exec(compile('\n'.join(lines) + '\n', '<transition>', 'exec'), namespace)
+    return namespace['transition']
+
+
+def _literal(namespace, v):
+    """Return the source of a constant, adding it to `namespace` if needed."""
+    if v is None or type(v) in (str, int):
+        return repr(v)
+    name = '_c%d' % len(namespace)
+    namespace[name] = v
+    return name
 
 
 def run_sm(sm, callback=None, val=None):
@@ -87,17 +577,20 @@ def run_sm(sm, callback=None, val=None):
     the next round of the state machine execution.
 
     """
+    send = sm.send
     try:
+        if callback is None:
+            while True:
+                val = send(val)
         while True:
-            val = sm.send(val)
-            if callback:
-                val = callback(sm, val)
+            val = send(val)
+            val = callback(sm, val)
     except StopIteration:
         pass
     return val
 
 
-def iter_sm(sm, evt_iter=None, callback=None, val=None):
+def iter_sm(sm, evt_iter=None, callback=None, val=None, batch_size=1):
     """Return iterator for a state machine.
 
     The iterator returned by this function consumes an event from the
@@ -114,21 +607,500 @@ def iter_sm(sm, evt_iter=None, callback=None, val=None):
     machine that was previously halted by the callback or stopped because
     the `evt_iter` iterator was exhausted.
 
+    When `batch_size` is greater than 1 events are read from `evt_iter`
+    that many at a time, saving a call to the iterator for each event.
+    Events read ahead are lost if the iterator returned by this function is
+    not run to completion.
+
+    """
+    if callback is None and batch_size <= 1:
+        if evt_iter is None:
+            return _iter_sm_values(sm, val)
+        return _iter_sm_events(sm, evt_iter, val)
+    return _iter_sm(sm, evt_iter, callback, val, batch_size)
+
+
+def _iter_sm(sm, evt_iter, callback, val, batch_size):
+    send = sm.send
+    next_evt = _next_method(evt_iter) if evt_iter is not None else None
+    buf, pos = (), 0
+    # StopIteration from the state machine, the callback or the events
+    # ends the iterator, it must not propagate out of the generator
+    try:
+        while True:
+            val = send(val)
+            if callback:
+                val = callback(sm, val)
+            pval = yield val
+            if pval is not None:
+                val = pval
+            elif next_evt is not None:
+                if batch_size > 1:
+                    if pos == len(buf):
+                        buf = list(itertools.islice(evt_iter, batch_size))
+                        pos = 0
+                        if not buf:
+                            return
+                    ctx, s_id_vec, _ = val
+                    val = (ctx, s_id_vec, buf[pos])
+                    pos += 1
+                else:
+                    ctx, s_id_vec, _ = val
+                    val = (ctx, s_id_vec, next_evt())
+    except StopIteration:
+        return
+
+
+def _iter_sm_events(sm, evt_iter, val):
+    """iter_sm() without callback, reading events one at a time."""
+    send = sm.send
+    next_evt = _next_method(evt_iter)
+    try:
+        while True:
+            val = send(val)
+            pval = yield val
+            if pval is not None:
+                val = pval
+            else:
+                ctx, s_id_vec, _ = val
+                val = (ctx, s_id_vec, next_evt())
+    except StopIteration:
+        return
+
+
+def _iter_sm_values(sm, val):
+    """iter_sm() without callback nor events."""
+    send = sm.send
+    try:
+        while True:
+            val = send(val)
+            pval = yield val
+            if pval is not None:
+                val = pval
+    except StopIteration:
+        return
+
+
+def drive_sm(sm, evt_iter, val=None):
+    """Run a state machine over the events from `evt_iter`.
+
+    Returns the list of values yielded by the state machine, the same list
+    as ``list(iter_sm(sm, evt_iter, val=val))`` but built without
+    resuming an iterator for each event.
+
+    """
+    out = []
+    append = out.append
+    send = sm.send
+    next_evt = _next_method(evt_iter)
+    try:
+        while True:
+            val = send(val)
+            append(val)
+            ctx, s_id_vec, _ = val
+            val = (ctx, s_id_vec, next_evt())
+    except StopIteration:
+        pass
+    return out
+
+
+def intern_table(tt):
+    """Return a copy of a transition table with interned string IDs.
+
+    Every string state ID and event in the (state_id, event) keys and in the
+    values of `tt` is interned, so that comparing the IDs returned by the
+    transition function with the current state ID usually reduces to an
+    identity check.
+
+    """
+    def i(v):
+        return _intern(v) if type(v) is str else v
+    return dict(((i(s), i(e)), i(v)) for (s, e), v in tt.items())
+
+
+def expand_char_class_table(tt):
+    """Return a copy of a transition table with character classes expanded.
+
+    Events that are strings of more than one character are taken to be
+    classes of single character events: each (state_id, chars) entry is
+    replaced by a (state_id, char) entry for every character in `chars`,
+    so that a single dictionary lookup finds the transition for any event.
+    Other entries are copied as they are and take precedence over the
+    expanded ones.
+
+    """
+    flat = {}
+    exact = {}
+    for (state_id, evt), next_state_id in tt.items():
+        if isinstance(evt, str) and len(evt) > 1:
+            for ch in evt:
+                flat[(state_id, ch)] = next_state_id
+        else:
+            exact[(state_id, evt)] = next_state_id
+    flat.update(exact)
+    return flat
+
+
+def flatten_tables(tt, nested, transient=()):
+    """Return a single transition table for a hierarchy of tables.
+
+    `tt` is the transition table of the outer state machine and `nested`
+    maps the IDs of its states running a nested state machine to the
+    nested machine's table, or to a (table, nested) tuple for deeper
+    hierarchies. Lookups missing from a table leave the state unchanged and
+    `transient` lists the IDs of states exiting as soon as they are
+    entered, all other states are assumed to never exit by themselves.
+
+    The states of the returned table are the state ID vectors reachable
+    from the initial (None, None) lookup and its events are the ones found
+    in the tables. Each entry is the vector reached by delivering the event
+    to the hierarchy as state_machine() does, so that the table can be run
+    by compile_dfa() or compiled by compile_transition_table() without any
+    nested state machine.
+
     """
+    machine = _nested_machine(tt, nested)
+    events = set()
+    _collect_events(machine, events)
+    events.discard(None)
+    flat = {}
+    first = _flat_step(machine, transient, None, None, None)
+    flat[(None, None)] = first
+    pending = [first] if first is not None else []
+    seen = set(pending)
+    while pending:
+        vec = pending.pop()
+        for evt in events:
+            nxt = _flat_step(machine, transient, vec[0], vec[1:], evt)
+            if nxt != vec:
+                flat[(vec, evt)] = nxt
+                if nxt is not None and nxt not in seen:
+                    seen.add(nxt)
+                    pending.append(nxt)
+    return flat
+
+
+def _nested_machine(tt, nested):
+    machines = {}
+    for state_id, sub in nested.items():
+        if isinstance(sub, tuple):
+            machines[state_id] = _nested_machine(*sub)
+        else:
+            machines[state_id] = (sub, {})
+    return tt, machines
+
+
+def _collect_events(machine, events):
+    tt, nested = machine
+    events.update(evt for _, evt in tt)
+    for sub in nested.values():
+        _collect_events(sub, events)
+
+
+def _flat_step(machine, transient, state_id, active, evt):
+    """Deliver `evt` to a machine, return its new vector or None if it stops.
+
+    `active` holds the IDs of the states active below `state_id`, it is
+    None when `state_id` has no active state.
+
+    """
+    tt, nested = machine
+    exited = set()
     while True:
-        val = sm.send(val)
-        if callback:
-            val = callback(sm, val)
-        pval = yield val
-        if pval is not None:
-            val = pval
-        elif evt_iter is not None:
-            val = (val[0], val[1], evt_iter.next())
+        next_state_id = tt.get((state_id, evt), state_id)
+        if next_state_id is None:
+            return None
+        if active is None or next_state_id != state_id:
+            state_id = next_state_id
+            sub = nested.get(state_id)
+            if sub is not None:
+                vec = _flat_step(sub, transient, state_id, None, evt)
+            elif state_id in transient:
+                vec = None
+            else:
+                return (state_id,)
+        else:
+            sub = nested.get(state_id)
+            if sub is None:
+                return (state_id,)
+            vec = _flat_step(sub, transient, active[0], active[1:], evt)
+        if vec is not None:
+            return (state_id,) + vec
+        # The state exited, the transition function gets a None event
+        if state_id in exited:
+            raise ValueError('state %r exits forever' % (state_id,))
+        exited.add(state_id)
+        active = evt = None
+
+
+def compile_transition_table(tt, states=None, events=None):
+    """Compile a transition table into a flat integer lookup table.
+
+    `tt` maps (state_id, event) tuples to the next state ID, like the
+    dictionaries used by the examples. `states` and `events` list every
+    state ID and event the table can be indexed with, they default to the
+    ones found in `tt`. None is always given index 0 in both, so that the
+    initial (None, None) lookup and the None event following the exit of a
+    state can be represented.
+
+    Returns a (state_to_idx, evt_to_idx, table) tuple. `table` is an
+    `array.array` of ``len(state_to_idx) * len(evt_to_idx)`` integers
+    indexed by ``state_idx * len(evt_to_idx) + evt_idx``. Each entry is
+    the index of the next state, which is the index of the current state
+    itself if `tt` has no entry for the pair, or TABLE_END if `tt` maps the
+    pair to None (the state machine stops).
+
+    """
+    if states is None:
+        states = [i for t, next_state_id in tt.items()
+                  for i in (t[0], next_state_id)]
+    if events is None:
+        events = [t[1] for t in tt]
+    state_to_idx = _index_map(states)
+    evt_to_idx = _index_map(events)
+    n_evt = len(evt_to_idx)
+    table = array.array('i', [s for s in range(len(state_to_idx))
+                              for _ in range(n_evt)])
+    for (state_id, evt), next_state_id in tt.items():
+        if next_state_id is None:
+            nxt = TABLE_END
+        else:
+            nxt = state_to_idx[next_state_id]
+        table[state_to_idx[state_id] * n_evt + evt_to_idx[evt]] = nxt
+    return state_to_idx, evt_to_idx, table
+
+
+def transition_from_table(state_to_idx, evt_to_idx, table):
+    """Return a transition function using a compiled transition table.
+
+    The parameters are the values returned by compile_transition_table().
+    State IDs and events missing from the table leave the state unchanged,
+    as ``tt.get(t, t[0])`` would.
+
+    """
+    # TABLE_END indexes the trailing None
+    idx_to_state = _id_list(state_to_idx) + [None]
+    n_evt = len(evt_to_idx)
+    s_idx = state_to_idx.get
+    e_idx = evt_to_idx.get
+    def transition(ctx, t):
+        s = s_idx(t[0])
+        e = e_idx(t[1])
+        if s is None or e is None:
+            return t[0]
+        return idx_to_state[table[s * n_evt + e]]
+    return transition
+
+
+def _run_dfa(table, n_evt, state, events, trace):
+    n = 0
+    for e in events:
+        if e >= 0:
+            nxt = table[state * n_evt + e]
+            if nxt == TABLE_END:
+                return TABLE_END, n
+            state = nxt
+        trace[n] = state
+        n += 1
+    return state, n
+
+
+def run_dfa(table, n_evt, state, events, trace):
+    """Run a compiled transition table over a sequence of event indices.
+
+    `state` is the index of the initial state and `events` holds event
+    indices, negative for events missing from the table. The index of the
+    state reached after each event is stored in `trace`, which must be at
+    least as long as `events`.
+
+    Returns the index of the final state, or TABLE_END if the state machine
+    stopped, and the number of entries stored in `trace`. The function is
+    replaced by its counterpart in the _smachine extension module when it
+    has been built, otherwise it is compiled with Numba on its first call
+    when Numba is installed.
+
+    """
+    global run_dfa
+    run_dfa = _njit(_run_dfa, cache=True)
+    return run_dfa(table, n_evt, state, events, trace)
+
+
+try:
+    from _smachine import run_dfa
+except ImportError:
+    pass
+
+
+def run_table(state_to_idx, evt_to_idx, table, events, state_id=None):
+    """Run a compiled transition table over the `events` sequence.
+
+    The first three parameters are the values returned by
+    compile_transition_table(). Events are mapped to their indices once and
+    run through run_dfa(), no state is instantiated. When `state_id` is
+    None the initial state is first looked up with the None event, like
+    state_machine() does.
+
+    Returns the list of state IDs reached after each event until the events
+    are exhausted or the state machine stops.
+
+    """
+    e_idx = evt_to_idx.get
+    evts = array.array('i', [e_idx(evt, -1) for evt in events])
+    if state_id is None:
+        evts.insert(0, 0)
+    trace = array.array('i', evts)
+    _, n = run_dfa(table, len(evt_to_idx), state_to_idx[state_id], evts, trace)
+    idx_to_state = _id_list(state_to_idx)
+    return [idx_to_state[s] for s in trace[:n]]
+
+
+def trace_events(table, n_evt, state, events):
+    """Run a compiled transition table and locate the state transitions.
+
+    The parameters are the same as run_dfa()'s, without the trace buffer.
+    Returns a (trace, transitions) tuple: `trace` holds the index of the
+    state reached after each event processed and `transitions` the
+    positions in `trace` where the state differs from the previous one,
+    starting from `state`. Replaying events against states with entry or
+    exit actions only needs to instantiate states at those positions.
+
+    When `events` is a NumPy array, `trace` and `transitions` are NumPy
+    arrays and the transitions are located with vectorized operations.
+
+    """
+    # An array argument means NumPy is already imported
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(events, np.ndarray):
+        events = np.ascontiguousarray(events, dtype=np.intc)
+        trace = np.empty_like(events)
+        _, n = run_dfa(table, n_evt, state, events, trace)
+        trace = trace[:n]
+        prev = np.concatenate(([state], trace[:-1]))
+        return trace, np.flatnonzero(trace != prev)
+    events = array.array('i', events)
+    trace = array.array('i', events)
+    _, n = run_dfa(table, n_evt, state, events, trace)
+    del trace[n:]
+    transitions = []
+    for i, s in enumerate(trace):
+        if s != state:
+            transitions.append(i)
+            state = s
+    return trace, transitions
+
+
+def compile_dfa(tt, initial_state=None, trace=False):
+    """Return a function running the transition table `tt` over events.
+
+    The returned function takes a sequence of events and returns the ID of
+    the state reached after the last one, or None if the state machine
+    stopped. It starts from `initial_state` or, when that is None, from the
+    state `tt` maps (None, None) to. Events missing from the table leave
+    the state unchanged. No state is instantiated, the events are run
+    through run_dfa(), so it only suits state machines whose states have no
+    side effects.
+
+    When `trace` is true the function returns a (state_id, trace) tuple
+    instead, `trace` being the list of state IDs reached after each event
+    processed.
+
+    """
+    state_to_idx, evt_to_idx, table = compile_transition_table(tt)
+    if initial_state is None:
+        start = table[0]
+    else:
+        start = state_to_idx[initial_state]
+    # TABLE_END indexes the trailing None
+    idx_to_state = _id_list(state_to_idx) + [None]
+    n_evt = len(evt_to_idx)
+    e_idx = evt_to_idx.get
+    def run(events):
+        if start == TABLE_END:
+            return (None, []) if trace else None
+        evts = array.array('i', [e_idx(evt, -1) for evt in events])
+        buf = array.array('i', evts)
+        state, n = run_dfa(table, n_evt, start, evts, buf)
+        if trace:
+            return idx_to_state[state], [idx_to_state[s] for s in buf[:n]]
+        return idx_to_state[state]
+    return run
+
+
+def codegen_sm(tt, initial_state=None, on_enter=None):
+    """Generate a function running the transition table `tt` over events.
+
+    Like compile_dfa() the returned function takes a sequence of events and
+    returns the ID of the final state, or None if the state machine
+    stopped, but its loop is generated Python code looking transitions up
+    in `tt` directly, which needs neither the events nor the states to be
+    mapped to integers.
+
+    The optional `on_enter` dictionary maps state IDs to functions called
+    with the context, the state ID and the event each time the state is
+    entered, the initial state included. The calls are inlined in the
+    generated loop, the context is passed to the returned function as its
+    optional second parameter.
+
+    """
+    if initial_state is None:
+        initial_state = tt.get((None, None))
+    on_enter = on_enter or {}
+    namespace = {'_tt': tt}
+    def literal(v):
+        return _literal(namespace, v)
+    def enter(indent, evt):
+        keyword = 'if'
+        for state_id, func in on_enter.items():
+            lines.append('%s%s state_id == %s:' % (indent, keyword,
+                                                   literal(state_id)))
+            lines.append('%s    %s(ctx, state_id, %s)' % (
+                indent, literal(func), evt))
+            keyword = 'elif'
+    lines = ['def run(events, ctx=None):',
+             '    state_id = %s' % literal(initial_state),
+             '    if state_id is None:',
+             '        return None',
+             '    get = _tt.get']
+    enter('    ', 'None')
+    lines.extend(['    for evt in events:',
+                  '        next_state_id = get((state_id, evt), state_id)',
+                  '        if next_state_id is None:',
+                  '            return None'])
+    if on_enter:
+        lines.append('        if (next_state_id is not state_id and'
+                     ' next_state_id != state_id):')
+        lines.append('            state_id = next_state_id')
+        enter('            ', 'evt')
+    else:
+        lines.append('        state_id = next_state_id')
+    lines.append('    return state_id')
+    exec(compile('\n'.join(lines) + '\n', '<codegen_sm>', 'exec'), namespace)
+    return namespace['run']
+
+
+def _index_map(ids):
+    idx = {None: 0}
+    for i in ids:
+        idx.setdefault(i, len(idx))
+    return idx
+
+
+def _id_list(idx):
+    ids = [None] * len(idx)
+    for i, n in idx.items():
+        ids[n] = i
+    return ids
 
 
 def load_tests(loader, tests, ignore):
-    tests.addTests(doctest.DocFileSuite("README"))
+    # Imported here so that importing the module does not load them
+    import doctest
+    import os
+    # Not module relative, which fails when the module is compiled
+    readme = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README')
+    tests.addTests(doctest.DocFileSuite(readme, module_relative=False))
     return tests
 
 if __name__ == "__main__":
+    import unittest
     unittest.main()